@@ -25,18 +25,41 @@ class Config:
     
     PROG_TIME_LIMIT = int(os.getenv('PROG_TIME_LIMIT', '5'))  # 秒
     PROG_MEMORY_LIMIT = int(os.getenv('PROG_MEMORY_LIMIT', '256')) # MB
-    PROG_OUTPUT_LIMIT = int(os.getenv('PROG_OUTPUT_LIMIT', '16')) # KB
+    # stdout 超过该大小判为 OLE, stderr 只截断; rlimit_wrapper 不设 RLIMIT_FSIZE, 这是唯一的输出限制
+    PROG_OUTPUT_LIMIT = int(os.getenv('PROG_OUTPUT_LIMIT', '16384')) # KB
 
     COMPILER_TIME_LIMIT = int(os.getenv('MAX_COMPILER_EXEC_TIME', '15'))  # 秒
     COMPILER_MEMORY_LIMIT = int(os.getenv('MAX_COMPILER_EXEC_MEM', '512')) # MB
     COMPILER_OUTPUT_LIMIT = int(os.getenv('MAX_COMPILER_EXEC_OUTPUT', '16384')) # KB
     
+    # 编译产物缓存, 以 (源码, 语言, 标准, 优化等级, 编译器版本, testlib) 的哈希为键; 默认关闭
+    # 缓存的可执行文件会被直接运行, 目录必须只有本用户可访问 (不存在时以 0700 创建)
+    COMPILE_CACHE_DIR = os.getenv('COMPILE_CACHE_DIR', '')
+    COMPILE_CACHE_SIZE = int(os.getenv('COMPILE_CACHE_SIZE', '256'))  # 最多保留的可执行文件数
+
     CHECKER_TIME_LIMIT = int(os.getenv('MAX_COMPILER_EXEC_TIME', '2'))  # 秒
     CHECKER_MEMORY_LIMIT = int(os.getenv('MAX_COMPILER_EXEC_MEM', '256')) # MB
     CHECKER_OUTPUT_LIMIT = int(os.getenv('MAX_COMPILER_EXEC_OUTPUT', '16')) # KB
 
+    # 单次对拍中同时评测的测试点数, 默认留出一个核心给 Web 进程
+    DIFF_WORKERS = int(os.getenv('DIFF_WORKERS', str(max(1, (os.cpu_count() or 2) - 1))))
+
     # AI 配置
     AI_TIMEOUT = int(os.getenv('AI_TIMEOUT', '60'))  # 秒
+    AI_REQUEST_TIMEOUT = float(os.getenv('AI_REQUEST_TIMEOUT', '20'))  # 秒, 单次请求的连接/写入超时, 超时后重试
+    AI_MAX_RETRIES = int(os.getenv('AI_MAX_RETRIES', '2'))
+    AI_MAX_TOKENS = int(os.getenv('AI_MAX_TOKENS', '0'))  # 代码生成的输出 token 上限, 0 表示不设置 (使用服务商默认)
+
+    # AI 流式输出合并: 首块立即发送, 之后块大小按倍数增长
+    AI_STREAM_MIN_BATCH_SIZE = int(os.getenv('AI_STREAM_MIN_BATCH_SIZE', '1'))
+    AI_STREAM_MAX_BATCH_SIZE = int(os.getenv('AI_STREAM_MAX_BATCH_SIZE', '32'))
+    AI_STREAM_GROWTH_FACTOR = float(os.getenv('AI_STREAM_GROWTH_FACTOR', '2'))
+    AI_STREAM_FLUSH_MS = int(os.getenv('AI_STREAM_FLUSH_MS', '100'))  # 毫秒
+
+    # 按提示词内容缓存 AI 生成结果
+    CACHE_AI_RESPONSES = os.getenv('CACHE_AI_RESPONSES', 'false').lower() == 'true'
+    AI_CACHE_SIZE = int(os.getenv('AI_CACHE_SIZE', '512'))
+    AI_CACHE_TTL = int(os.getenv('AI_CACHE_TTL', '3600'))  # 秒
 
     SYSTEM_OCR_API_KEY = os.getenv('SYSTEM_OCR_API_KEY')
     SYSTEM_OCR_API_URL = os.getenv('SYSTEM_OCR_API_URL')
@@ -52,6 +75,9 @@ class Config:
     MAIL_USE_TLS = os.getenv('MAIL_USE_TLS', 'false').lower() == 'true'
     MAIL_USERNAME = os.getenv('MAIL_USERNAME')
     MAIL_PASSWORD = os.getenv('MAIL_PASSWORD')
+    MAIL_POOL_SIZE = int(os.getenv('MAIL_POOL_SIZE', '4'))  # 保留的空闲 SMTP 连接数
+    MAIL_WORKERS = int(os.getenv('MAIL_WORKERS', '2'))  # 后台发信线程数
+    MAIL_MAX_RETRIES = int(os.getenv('MAIL_MAX_RETRIES', '3'))
 
 class DevelopmentConfig(Config):
     DEBUG = True
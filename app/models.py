@@ -112,6 +112,36 @@ class TestCase(db.Model):
             'created_at': self.created_at.isoformat()
         }
 
+    @staticmethod
+    def new_row(**values):
+        """构造一个未映射为 ORM 对象的测试点字典, 可直接用于批量 INSERT/UPDATE"""
+        row = {
+            'status': 'PENDING',
+            'input_data': None,
+            'user_output': None,
+            'std_output': None,
+            'detail': None,
+            'time_used': None,
+            'memory_used': None,
+        }
+        row.update(values)
+        return row
+
+    @staticmethod
+    def row_to_dict(row):
+        """与 to_dict 相同的序列化格式, 作用于 new_row 构造的字典"""
+        return {
+            'id': row.get('id'),
+            'status': row['status'],
+            'input': row['input_data'],
+            'output': row['user_output'],
+            'answer': row['std_output'],
+            'detail': row['detail'],
+            'time_used': row['time_used'],
+            'memory_used': row['memory_used'],
+            'created_at': row['created_at'].isoformat()
+        }
+
 class VerificationCode(db.Model):
     __tablename__ = 'verification_codes'
     
@@ -3,10 +3,10 @@ from flask_restful import Resource
 from flask_login import login_required, current_user
 from PIL import Image
 from app.models import Session
-from app.exceptions import APIError, AuthorizationError
+from app.exceptions import APIError
 from app.schemas.ai import StreamGenerateCodeQuerySchema
 from app.utils.ai_client import CodeGenerationClient, OCRClient
-from app.utils.sse import sse_response
+from app.utils.sse import sse_response, sse_chunk
 import logging
 
 logger = logging.getLogger(__name__)
@@ -45,10 +45,8 @@ class StreamGenerateCode(Resource):
     def generate(self, gen_type, session_id):
         user_id = current_user.id
 
-        # 获取会话
-        session = Session.query.get_or_404(session_id)
-        if session.user_id != user_id:
-            raise AuthorizationError("Not your session")
+        # 获取会话 (同时验证权限)
+        session = Session.query.filter_by(id=session_id, user_id=user_id).first_or_404()
 
         # 获取用户AI配置
         user = session.user
@@ -83,7 +81,7 @@ class StreamGenerateCode(Resource):
             raise APIError("Invalid generation type")
 
         for data in generator_func(context):
-            yield sse_response('chunk', {'content': data})
+            yield sse_chunk(data)
         yield sse_response('finish', {})
 
 
@@ -121,7 +119,7 @@ class StreamOCR(Resource):
                 img.load() # Ensure image is loaded
 
                 for content in ocr_client.perform_ocr_stream(img):
-                    yield sse_response('chunk', {'content': content})
+                    yield sse_chunk(content)
                 yield sse_response('finish', {})
 
             except Exception as e:
@@ -5,7 +5,7 @@ from app.models import User, VerificationCode
 from app.extensions import db
 from app.exceptions import APIError
 from app.schemas.auth import SendVerificationCodeSchema, RegisterSchema, LoginSchema, UserProfileUpdateSchema
-from app.utils.email_sender import send_verification_email
+from app.utils.email_sender import send_verification_email_async
 import random
 from datetime import datetime, timedelta, timezone
 
@@ -30,11 +30,9 @@ class SendVerificationCode(Resource):
         db.session.add(ver_code)
         db.session.commit()
         
-        # 发送邮件
-        if send_verification_email(email, code):
-            return {'message': 'Verification code sent'}, 200
-        else:
-            raise APIError('Failed to send verification email', 500)
+        # 发送邮件 (后台线程发送, 不等待 SMTP 完成)
+        send_verification_email_async(email, code)
+        return {'message': 'Verification code sent'}, 200
 
 
 class Register(Resource):
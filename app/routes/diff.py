@@ -2,12 +2,16 @@ from flask import request, current_app, Response, stream_with_context
 from flask_restful import Resource
 from flask_login import login_required, current_user
 from app.extensions import db
-from app.exceptions import AuthenticationError, AuthorizationError
+from app.exceptions import AuthenticationError, NotFoundError
 from app.models import Session, TestCase
 from app.schemas.diff import StartDiffQuerySchema, RerunDiffQuerySchema
 from app.utils.sandbox import run_compiler, run_program, run_checker
 from app.utils.sse import sse_response
+from sqlalchemy import insert, update
 from tempfile import TemporaryDirectory, NamedTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from itertools import islice
 from pathlib import Path
 from datetime import datetime, timezone
 from signal import Signals
@@ -15,12 +19,50 @@ import string
 import random
 import logging
 import os
+import threading
 import time
 
 logger = logging.getLogger(__name__)
 
+# 每个测试点都会推送一次进度事件, 直接套用预先格式化好的 SSE 模板, 省去 JSON 编码
+_STATUS_TMPL = b'event: status\ndata: {"status":"Running test %d/%d","timestamp":"%s"}\n\n'
 
-def judge(testcase: TestCase,
+
+def _progress_event(current, total, timestamp):
+    return _STATUS_TMPL % (current, total, timestamp.encode())
+
+
+# 测试点以字典形式累积, 每攒够一批再统一写入数据库
+_WRITE_BATCH_SIZE = 50
+
+
+# 本进程内正在运行的对拍的停止信号, 由 StopDiff 置位;
+# 其他 worker 进程发出的停止请求仍通过数据库中的 stop_requested 字段传递
+_stop_events: dict[int, threading.Event] = {}
+_stop_events_lock = threading.Lock()
+
+
+def _acquire_stop_event(session_id) -> threading.Event:
+    with _stop_events_lock:
+        event = _stop_events.setdefault(session_id, threading.Event())
+    event.clear()
+    return event
+
+
+def _release_stop_event(session_id, event):
+    with _stop_events_lock:
+        if _stop_events.get(session_id) is event:
+            del _stop_events[session_id]
+
+
+def _signal_stop_event(session_id):
+    with _stop_events_lock:
+        event = _stop_events.get(session_id)
+    if event is not None:
+        event.set()
+
+
+def judge(testcase: dict,
           gen_exe_file: os.PathLike | None,
           user_exe_file: os.PathLike,
           std_exe_file: os.PathLike,
@@ -30,66 +72,156 @@ def judge(testcase: TestCase,
         random_token = ''.join(random.choice(string.ascii_letters) for _ in range(16))
         gen_result, input_data, stderr, _, _ = run_program(gen_exe_file, [random_token])
 
-        testcase.input_data = input_data
+        testcase['input_data'] = input_data
         if gen_result['type'] != 'OK':
-            testcase.status = f"Generator {gen_result['type']}"
-            testcase.detail = f"Generator {gen_result['type']}"
+            testcase['status'] = f"Generator {gen_result['type']}"
+            testcase['detail'] = f"Generator {gen_result['type']}"
             if gen_result['type'] == 'RE':
-                testcase.detail += f" ({Signals(gen_result['code']).name})"
+                testcase['detail'] += f" ({Signals(gen_result['code']).name})"
             return False
         elif gen_result['code'] != 0:
-            testcase.status = f"Generator RE"
-            testcase.detail = stderr
+            testcase['status'] = f"Generator RE"
+            testcase['detail'] = stderr
             return False
     else:
-        input_data = testcase.input_data
-
-    # run user code
-    user_result, user_output, _, time_used, memory_used = run_program(user_exe_file, input_data=input_data)
-    testcase.user_output = user_output
-    testcase.time_used = time_used
-    testcase.memory_used = memory_used
-    if user_result['type'] != 'OK':
-        testcase.status = f"User {user_result['type']}"
-        testcase.detail = f"User {user_result['type']}"
-        if user_result['type'] == 'RE':
-            testcase.detail += f" ({Signals(user_result['code']).name})"
-        return False
-
-    # run std code
-    std_result, std_output, _, _, _ = run_program(std_exe_file, input_data=input_data)
-    testcase.std_output = std_output
-    if std_result['type'] != 'OK':
-        testcase.status = f"Std {std_result['type']}"
-        testcase.detail = f"Std {std_result['type']}"
-        if std_result['type'] == 'RE':
-            testcase.detail += f" ({Signals(std_result['code']).name})"
-        return False
-
-    # run checker
+        input_data = testcase['input_data']
+
     with (
-        NamedTemporaryFile('w+', delete=True) as input_file,
+        NamedTemporaryFile('wb+', delete=True) as input_file,
         NamedTemporaryFile('w+', delete=True) as output_file,
         NamedTemporaryFile('w+', delete=True) as answer_file
     ):
-        input_file.write(input_data)
+        # 输入只写一次文件, 用户程序、标准程序与 checker 都直接读这个文件
+        input_file.write(input_data.encode())
+        input_file.flush()
+
+        # run user code
+        with open(input_file.name, 'rb') as stdin:
+            user_result, user_output, _, time_used, memory_used = run_program(user_exe_file, input_data=stdin)
+        testcase['user_output'] = user_output
+        testcase['time_used'] = time_used
+        testcase['memory_used'] = memory_used
+        if user_result['type'] != 'OK':
+            testcase['status'] = f"User {user_result['type']}"
+            testcase['detail'] = f"User {user_result['type']}"
+            if user_result['type'] == 'RE':
+                testcase['detail'] += f" ({Signals(user_result['code']).name})"
+            return False
+
+        # run std code
+        with open(input_file.name, 'rb') as stdin:
+            std_result, std_output, _, _, _ = run_program(std_exe_file, input_data=stdin)
+        testcase['std_output'] = std_output
+        if std_result['type'] != 'OK':
+            testcase['status'] = f"Std {std_result['type']}"
+            testcase['detail'] = f"Std {std_result['type']}"
+            if std_result['type'] == 'RE':
+                testcase['detail'] += f" ({Signals(std_result['code']).name})"
+            return False
+
+        # run checker
         output_file.write(user_output)
         answer_file.write(std_output)
 
-        input_file.flush()
         output_file.flush()
         answer_file.flush()
 
         result = run_checker(chk_exe_file, input_file.name, output_file.name, answer_file.name)
-        testcase.status = result['status']
-        testcase.detail = result['detail']
-        if testcase.status != 'OK':
+        testcase['status'] = result['status']
+        testcase['detail'] = result['detail']
+        if testcase['status'] != 'OK':
             return False
 
-    testcase.status = 'OK'
+    testcase['status'] = 'OK'
     return True
 
 
+def _judge_in_order(testcases, judge_args, workers):
+    """
+    用线程池并行评测测试点, 按提交顺序逐个产出 (测试点, wait)
+
+    调用 wait() 阻塞等待该测试点评测完成并返回是否通过, 调用方可以在等待之前先推送进度。
+    每个沙箱都是独立子进程, 同时最多有 workers 个测试点在评测;
+    调用方提前结束迭代时, 尚未开始的测试点会被取消
+    """
+    app = current_app._get_current_object()
+
+    def judge_one(testcase):
+        with app.app_context():
+            return judge(testcase, *judge_args)
+
+    testcases = iter(testcases)
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        pending = deque((testcase, pool.submit(judge_one, testcase)) for testcase in islice(testcases, workers))
+        while pending:
+            testcase, future = pending.popleft()
+            yield testcase, future.result
+            # 调用方取完结果后再补充下一个测试点, 保持窗口大小
+            for next_testcase in islice(testcases, 1):
+                pending.append((next_testcase, pool.submit(judge_one, next_testcase)))
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def _flush_batch(stmt, batch):
+    """批量写入测试点 (INSERT 或按主键 UPDATE) 并提交"""
+    if batch:
+        db.session.execute(stmt, batch)
+        batch.clear()
+    db.session.commit()
+
+
+def _write_file_bytes(path: os.PathLike, data: bytes):
+    """直接通过文件描述符写入字节, 绕过文本模式的编码与换行处理"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+def compile_codes(temp_dir: Path, codes):
+    """
+    并行编译多份代码
+
+    Args:
+        temp_dir: 临时目录, 源码与可执行文件都放在这里
+        codes: (名称, 代码, 优化等级) 的序列
+
+    Returns:
+        按输入顺序排列的 (名称, 事件类型, 事件数据) 列表
+    """
+    app = current_app._get_current_object()
+
+    def compile_one(s, code, optimize_level):
+        with app.app_context():
+            return run_compiler(
+                temp_dir / f'{s}_code',
+                temp_dir / f'{s}_exe',
+                code['lang'],
+                code['std'],
+                optimize_level
+            )
+
+    # 写文件很快, 顺序完成; 编译器调用是子进程, 用线程并行
+    for s, code, _ in codes:
+        _write_file_bytes(temp_dir / f'{s}_code', code['content'].encode('utf-8'))
+        (temp_dir / f'{s}_exe').touch()
+
+    with ThreadPoolExecutor(max_workers=len(codes)) as pool:
+        futures = [(s, pool.submit(compile_one, s, code, level)) for s, code, level in codes]
+
+    results = []
+    for s, future in futures:
+        type, data = future.result()
+        data['message'] = f"{s} code: {data['message']}"
+        results.append((s, type, data))
+    return results
+
+
 class StartDiff(Resource):
     @login_required
     def get(self, session_id):
@@ -108,12 +240,8 @@ class StartDiff(Resource):
                 
                 user_id = current_user.id
                 
-                # 获取会话
-                session = Session.query.get_or_404(session_id)
-                
-                # 验证权限
-                if session.user_id != user_id:
-                    raise AuthorizationError("Not your session")
+                # 获取会话 (同时验证权限)
+                session = Session.query.filter_by(id=session_id, user_id=user_id).first_or_404()
                 
                 # 保存原始代码
                 user_code = session.user_code.copy() if session.user_code else {}
@@ -156,49 +284,50 @@ class StartDiff(Resource):
             temp_dir = Path(temp_dir)
 
             # compile codes
-            for s, code in (('user', user_code), ('std', std_code), ('gen', gen_code)):
-                yield sse_response('status', {'status': f"Compiling {s} code"})
-
-                code_file = temp_dir / f'{s}_code'
-                exe_file = temp_dir / f'{s}_exe'
-                code_file.write_text(code['content'])
-                exe_file.touch()
-                type, data = run_compiler(
-                    code_file,
-                    exe_file,
-                    code['lang'],
-                    code['std'],
-                    0 if s == 'gen' else 2
-                )
-                data['message'] = f"{s} code: {data['message']}"
-
+            yield sse_response('status', {'status': "Compiling codes"})
+            for s, type, data in compile_codes(
+                temp_dir,
+                (('user', user_code, 2), ('std', std_code, 2), ('gen', gen_code, 0))
+            ):
                 yield sse_response(type, data)
                 if type == 'failed':
                     return
 
+            stop_event = _acquire_stop_event(session_id)
+            batch = []
             try:
-                for i in range(max_tests):
-                    yield sse_response('status', {"status": f"Running test {i + 1}/{max_tests}"})
-                    testcase = TestCase(
+                testcases = (
+                    TestCase.new_row(
                         session_id=session_id,
-                        created_at=datetime.now(timezone.utc)
+                        created_at=datetime.fromtimestamp(time.time(), tz=timezone.utc)
                     )
+                    for _ in range(max_tests)
+                )
+                judge_args = (temp_dir / 'gen_exe', temp_dir / 'user_exe', temp_dir / 'std_exe', checker_exe_file)
+
+                for i, (testcase, wait) in enumerate(
+                    _judge_in_order(testcases, judge_args, current_app.config['DIFF_WORKERS'])
+                ):
+                    # 在等待该测试点的结果之前推送进度
+                    yield _progress_event(i + 1, max_tests, datetime.utcnow().isoformat())
+                    ret = wait()
 
-                    gen_exe_file = temp_dir / 'gen_exe'
-                    user_exe_file = temp_dir / 'user_exe'
-                    std_exe_file = temp_dir / 'std_exe'
-                    ret = judge(testcase, gen_exe_file, user_exe_file, std_exe_file, checker_exe_file)
+                    batch.append(testcase)
+                    if len(batch) >= _WRITE_BATCH_SIZE:
+                        _flush_batch(insert(TestCase), batch)
 
-                    db.session.add(testcase)
                     yield sse_response('test_result', {
                         'test_num': i,
-                        'test_case': testcase.to_dict()
+                        'test_case': TestCase.row_to_dict(testcase)
                     })
 
                     if not ret:
                         break
 
-                    # Check for stop signal every 1 second
+                    if stop_event.is_set():
+                        break
+
+                    # Check for stop signal from other workers every 1 second
                     if time.time() - last_check_time > 1.0:
                         db.session.refresh(session)
                         if session.stop_requested:
@@ -206,7 +335,8 @@ class StartDiff(Resource):
                         last_check_time = time.time()
 
             finally:
-                db.session.commit()
+                _release_stop_event(session_id, stop_event)
+                _flush_batch(insert(TestCase), batch)
 
             yield sse_response('finish', {})
 
@@ -216,10 +346,14 @@ class StopDiff(Resource):
     def post(self, session_id):
         """停止当前对拍"""
         # 实际实现需要维护执行进程映射
-        # 标记会话为停止状态
-        session = Session.query.get_or_404(session_id)
-        session.stop_requested = True
+        # 标记会话为停止状态 (单条 UPDATE, 同时验证权限)
+        updated = Session.query.filter_by(id=session_id, user_id=current_user.id).update(
+            {'stop_requested': True}, synchronize_session=False
+        )
+        if not updated:
+            raise NotFoundError('Session', session_id)
         db.session.commit()
+        _signal_stop_event(session_id)
         return {'stopped': True, 'session_id': session_id}, 200
 
 
@@ -236,10 +370,7 @@ class RerunDiff(Resource):
         def generator():
             try:
                 user_id = current_user.id
-                session = Session.query.get_or_404(session_id)
-                
-                if session.user_id != user_id:
-                    raise AuthorizationError("Not your session")
+                session = Session.query.filter_by(id=session_id, user_id=user_id).first_or_404()
                 
                 # 保存原始代码
                 user_code = session.user_code.copy()
@@ -268,44 +399,51 @@ class RerunDiff(Resource):
         last_check_time = time.time()
 
         session = Session.query.get_or_404(session_id)
-        test_cases = session.test_cases
+        test_cases = [
+            TestCase.new_row(id=id, session_id=session_id, input_data=input_data, created_at=created_at)
+            for id, input_data, created_at in db.session.query(
+                TestCase.id, TestCase.input_data, TestCase.created_at
+            ).filter_by(session_id=session_id).order_by(TestCase.id)
+        ]
 
         checker_exe_file = Path(current_app.config['CHECKER_EXECUTABLE_PREFIX']) / checker
 
         with TemporaryDirectory() as temp_dir:
             temp_dir = Path(temp_dir)
 
-            for s, code in (('user', user_code), ('std', std_code)):
-                yield sse_response('status', {'status': f"Compiling {s} code"})
-
-                code_file = temp_dir / f'{s}_code'
-                exe_file = temp_dir / f'{s}_exe'
-                code_file.write_text(code['content'])
-                exe_file.touch()
-                type, data = run_compiler(code_file, exe_file, code['lang'], code['std'])
-                data['message'] = f"{s} code: {data['message']}"
-
+            yield sse_response('status', {'status': "Compiling codes"})
+            for s, type, data in compile_codes(temp_dir, (('user', user_code, 2), ('std', std_code, 2))):
                 yield sse_response(type, data)
                 if type == 'failed':
                     return
 
+            stop_event = _acquire_stop_event(session_id)
+            batch = []
             try:
-                for i, testcase in enumerate(test_cases):
-                    yield sse_response('status', {"status": f"Running test {i + 1}/{len(test_cases)}"})
-                    
-                    user_exe_file = temp_dir / 'user_exe'
-                    std_exe_file = temp_dir / 'std_exe'
-                    ret = judge(testcase, None, user_exe_file, std_exe_file, checker_exe_file)
+                judge_args = (None, temp_dir / 'user_exe', temp_dir / 'std_exe', checker_exe_file)
+
+                for i, (testcase, wait) in enumerate(
+                    _judge_in_order(test_cases, judge_args, current_app.config['DIFF_WORKERS'])
+                ):
+                    yield _progress_event(i + 1, len(test_cases), datetime.utcnow().isoformat())
+                    ret = wait()
+
+                    batch.append(testcase)
+                    if len(batch) >= _WRITE_BATCH_SIZE:
+                        _flush_batch(update(TestCase), batch)
 
                     yield sse_response('test_result', {
                         'test_num': i,
-                        'test_case': testcase.to_dict()
+                        'test_case': TestCase.row_to_dict(testcase)
                     })
 
                     if not ret:
                         break
 
-                    # Check for stop signal every 1 second
+                    if stop_event.is_set():
+                        break
+
+                    # Check for stop signal from other workers every 1 second
                     if time.time() - last_check_time > 1.0:
                         db.session.refresh(session)
                         if session.stop_requested:
@@ -313,7 +451,8 @@ class RerunDiff(Resource):
                         last_check_time = time.time()
 
             finally:
-                db.session.commit()
+                _release_stop_event(session_id, stop_event)
+                _flush_batch(update(TestCase), batch)
 
             yield sse_response('finish', {})
 
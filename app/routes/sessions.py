@@ -3,8 +3,8 @@ from flask_restful import Resource
 from flask_login import login_required, current_user
 from app.models import Session, TestCase
 from app.extensions import db
-from app.exceptions import APIError
 from app.schemas.session import SessionCreateSchema, SessionUpdateSchema, SessionListQuerySchema
+from sqlalchemy import func, case
 from datetime import datetime, timezone
 import logging
 import json
@@ -36,6 +36,9 @@ class SessionList(Resource):
         # 分页
         pagination = query.paginate(page=page, per_page=per_page, error_out=False)
         
+        # 一次聚合查询统计本页所有会话的测试点数量与 AC 数量
+        stats = self._collect_case_stats([session.id for session in pagination.items])
+        
         # 构建响应
         sessions = [{
             'id': session.id,
@@ -43,8 +46,8 @@ class SessionList(Resource):
             'description': session.description[:100] + '...' if session.description and len(session.description) > 100 else session.description,
             'created_at': session.created_at.isoformat(),
             'updated_at': session.updated_at.isoformat(),
-            'test_case_count': len(session.test_cases),
-            'success_rate': self._calculate_success_rate(session.test_cases)
+            'test_case_count': stats.get(session.id, (0, 0))[0],
+            'success_rate': self._calculate_success_rate(*stats.get(session.id, (0, 0)))
         } for session in pagination.items]
         
         return {
@@ -55,12 +58,22 @@ class SessionList(Resource):
             'pages': pagination.pages
         }
     
-    def _calculate_success_rate(self, test_cases):
+    def _collect_case_stats(self, session_ids):
+        """统计每个会话的 (测试点总数, AC 数)"""
+        if not session_ids:
+            return {}
+        rows = db.session.query(
+            TestCase.session_id,
+            func.count(TestCase.id),
+            func.sum(case((TestCase.status == 'AC', 1), else_=0))
+        ).filter(TestCase.session_id.in_(session_ids)).group_by(TestCase.session_id).all()
+        return {session_id: (total, ac_count or 0) for session_id, total, ac_count in rows}
+    
+    def _calculate_success_rate(self, total, ac_count):
         """计算成功率"""
-        if not test_cases:
+        if not total:
             return 0.0
-        ac_count = sum(1 for tc in test_cases if tc.status == 'AC')
-        return round((ac_count / len(test_cases)) * 100, 1)
+        return round((ac_count / total) * 100, 1)
     
     @login_required
     def post(self):
@@ -106,10 +119,7 @@ class SessionDetail(Resource):
     def get(self, session_id):
         """获取会话详情"""
         user_id = current_user.id
-        session = Session.query.get_or_404(session_id)
-        
-        if session.user_id != user_id:
-            raise APIError('Not your session', 403)
+        session = Session.query.filter_by(id=session_id, user_id=user_id).first_or_404()
         
         return session.to_dict(include_cases=True)
     
@@ -117,10 +127,7 @@ class SessionDetail(Resource):
     def put(self, session_id):
         """更新会话"""
         user_id = current_user.id
-        session = Session.query.get_or_404(session_id)
-        
-        if session.user_id != user_id:
-            raise APIError('Not your session', 403)
+        session = Session.query.filter_by(id=session_id, user_id=user_id).first_or_404()
         
         schema = SessionUpdateSchema()
         data = schema.load(request.get_json())
@@ -153,10 +160,7 @@ class SessionDetail(Resource):
     def delete(self, session_id):
         """删除会话"""
         user_id = current_user.id
-        session = Session.query.get_or_404(session_id)
-        
-        if session.user_id != user_id:
-            raise APIError('Not your session', 403)
+        session = Session.query.filter_by(id=session_id, user_id=user_id).first_or_404()
         
         db.session.delete(session)
         db.session.commit()
@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from flask import current_app
+from functools import lru_cache
+import hashlib
+import json
+import threading
+import time
+
+
+class LRUBackend:
+    """进程内 LRU 缓存后端, 每个条目带过期时间"""
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+
+class LLMCache:
+    """
+    LLM 回复缓存
+
+    以 (接口地址, 模型, 系统提示, 用户提示) 的 sha256 为键做精确匹配, 命中时直接返回之前的完整回复
+    """
+
+    def __init__(self, backend, ttl=3600):
+        self._backend = backend
+        self._ttl = ttl
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def make_key(base_url, ai_model, system_prompt, user_question):
+        # 不同服务商可能使用相同的模型名, 键中包含 base_url 以免互相命中
+        payload = json.dumps({'b': base_url, 'm': ai_model, 's': system_prompt, 'u': user_question}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key):
+        return self._backend.get(key)
+
+    def set(self, key, content):
+        self._backend.set(key, content, self._ttl)
+
+
+def get_llm_cache() -> LLMCache | None:
+    """获取当前应用的 LLM 缓存, 未开启 CACHE_AI_RESPONSES 时返回 None"""
+    config = current_app.config
+    if not config['CACHE_AI_RESPONSES']:
+        return None
+
+    cache = current_app.extensions.get('llm_cache')
+    if cache is None:
+        cache = current_app.extensions.setdefault(
+            'llm_cache',
+            LLMCache(LRUBackend(config['AI_CACHE_SIZE']), ttl=config['AI_CACHE_TTL'])
+        )
+    return cache
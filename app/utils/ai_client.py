@@ -1,17 +1,147 @@
-from openai import OpenAI
-from base64 import b64encode
+from __future__ import annotations
 from flask import current_app
+from functools import lru_cache
 from app.exceptions import APIError
+from app.utils.ai_cache import LLMCache, get_llm_cache
 from PIL import Image
+from typing import TYPE_CHECKING
 import logging
 import base64
 import io
+import re
+import threading
+import time
+
+if TYPE_CHECKING:
+    from openai import OpenAI
 
 logger = logging.getLogger(__name__)
 
 
-class CodeGenerationClient:
-    GENERATOR_SYSTEM_PROMPT = """
+@lru_cache(maxsize=1)
+def _get_http_client():
+    """所有 OpenAI 客户端共用的连接池 (按目标主机分别保持长连接)"""
+    import httpx
+    return httpx.Client(
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)
+    )
+
+
+_openai_lock = threading.Lock()
+
+
+def _get_openai(api_key, base_url, read_timeout) -> OpenAI:
+    """按 (api_key, base_url) 复用 OpenAI 客户端, 以复用其底层 HTTP 连接池"""
+    # lru_cache 本身不保证只构造一次, 加锁避免并发请求同时创建多个客户端与连接池
+    with _openai_lock:
+        return _create_openai(api_key, base_url, read_timeout)
+
+
+@lru_cache(maxsize=32)
+def _create_openai(api_key, base_url, read_timeout) -> OpenAI:
+    # SDK 导入开销较大 (httpx, pydantic 等), 推迟到第一次实际调用 AI 时
+    import httpx
+    from openai import OpenAI
+
+    # 显式设置超时并关闭 SDK 自带的重试, 避免默认的 600 秒超时与指数退避
+    return OpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        timeout=httpx.Timeout(connect=5.0, read=read_timeout, write=30.0, pool=5.0),
+        max_retries=0,
+        http_client=_get_http_client()
+    )
+
+
+def _create_with_retry(client: OpenAI, **kwargs):
+    """
+    发起 chat completion 请求, 超时后重新发起
+
+    连接、写入与等待连接池的超时取 AI_REQUEST_TIMEOUT, 卡在这些阶段的请求直接重发;
+    读超时仍为 AI_TIMEOUT, 流式响应中两个片段之间的间隔 (首字较慢或推理模型) 也受它约束。
+    流式请求只重试建立连接到收到响应头这一段, 已开始输出后不再重试。
+    """
+    import httpx
+    from openai import APITimeoutError
+
+    config = current_app.config
+    timeout = httpx.Timeout(config['AI_REQUEST_TIMEOUT'], read=config['AI_TIMEOUT'])
+    max_retries = config['AI_MAX_RETRIES']
+    for attempt in range(max_retries + 1):
+        try:
+            return client.chat.completions.create(timeout=timeout, **kwargs)
+        except APITimeoutError:
+            if attempt == max_retries:
+                raise
+            logger.warning(f'AI request timed out, retrying ({attempt + 1}/{max_retries})')
+
+
+def _iter_deltas(stream, ai_model, start, finish_reasons=None):
+    """
+    从流式响应中取出文本片段, 并在结束时记录各阶段耗时
+
+    ttft: 发起请求到收到第一个片段; tpot: 之后平均每个片段的间隔; total: 整个请求耗时
+    给出 finish_reasons 列表时, 把响应中出现的 finish_reason 追加到其中
+    """
+    first = None
+    count = 0
+    for chunk in stream:
+        choice = chunk.choices[0]
+        if finish_reasons is not None and choice.finish_reason is not None:
+            finish_reasons.append(choice.finish_reason)
+        delta = choice.delta
+        if (content := getattr(delta, 'content', None)) is not None:
+            if first is None:
+                first = time.perf_counter()
+            count += 1
+            yield content
+
+    end = time.perf_counter()
+    if first is None:
+        logger.info(f'AI stream [{ai_model}] finished without content: total={end - start:.3f}s')
+    else:
+        tpot = (end - first) / (count - 1) if count > 1 else 0.0
+        logger.info(
+            f'AI stream [{ai_model}] ttft={first - start:.3f}s tpot={tpot * 1000:.1f}ms '
+            f'total={end - start:.3f}s chunks={count}'
+        )
+
+
+def _batch_deltas(deltas):
+    """
+    将流式返回的 token 片段合并成较大的块再产出
+
+    第一块立即发送以保证首字延迟, 之后每块的大小按 growth_factor 几何增长,
+    直到 max_batch_size; 距上次发送超过 flush_ms 时也会立即发送。
+    """
+    config = current_app.config
+    batch_size = config['AI_STREAM_MIN_BATCH_SIZE']
+    max_batch_size = config['AI_STREAM_MAX_BATCH_SIZE']
+    growth_factor = config['AI_STREAM_GROWTH_FACTOR']
+    flush_interval = config['AI_STREAM_FLUSH_MS'] / 1000
+
+    buffer = []
+    last_flush = time.monotonic()
+    try:
+        for delta in deltas:
+            buffer.append(delta)
+            now = time.monotonic()
+            if len(buffer) >= batch_size or now - last_flush >= flush_interval:
+                yield ''.join(buffer)
+                buffer.clear()
+                last_flush = now
+                batch_size = min(max_batch_size, int(batch_size * growth_factor))
+    except APIError:
+        # 先把出错前已收到的内容发出去, 再把错误交给调用方
+        if buffer:
+            yield ''.join(buffer)
+        raise
+    if buffer:
+        yield ''.join(buffer)
+
+
+# 系统提示较长, 定义在模块级供各客户端类共享
+GENERATOR_SYSTEM_PROMPT = """
 ## Task: Competitive Programming Data Generator
 
 You are a specialized AI assistant whose sole task is to generate **C++ test data generators** for competitive programming problems.
@@ -51,12 +181,8 @@ The user will provide the problem details in two distinct, mandatory sections:
 
 **Produce raw C++ code only.** Do not include any extra explanatory text, comments outside of the code block, or Markdown notations (e.g., **DO NOT** use ```cpp ... ```).
 """
-    GENERATOR_USER_PROMPT = """
-Write the data generator for the following problem:
 
-{}
-"""
-    STANDARD_SYSTEM_PROMPT = """
+STANDARD_SYSTEM_PROMPT = """
 **Role:** You are a C++17 Reference Implementation Generator. Your purpose is to generate logically perfect, naive brute-force solutions for competitive programming problems. These solutions are used as "Reference Code" for stress testing (checking against optimized solutions).
 
 **Input:** A competitive programming problem description.
@@ -80,73 +206,132 @@ Write the data generator for the following problem:
     - **NO Markdown:** Do not use code blocks (like ```cpp ... ```). Do not write introductory or concluding text.
     - **Output ONLY the code.** The output must start with the first preprocessor directive (`#include`, `using namespace`, etc.) and end with the closing brace `}` of the `main` function.
 """
+
+
+class CodeGenerationClient:
+    GENERATOR_SYSTEM_PROMPT = GENERATOR_SYSTEM_PROMPT
+    GENERATOR_USER_PROMPT = """
+Write the data generator for the following problem:
+
+{}
+"""
+    STANDARD_SYSTEM_PROMPT = STANDARD_SYSTEM_PROMPT
     STANDARD_USER_PROMPT = """
 Generate the brute-force C++17 solution for the following problem:
 
 {}
 """
 
+    CACHE_REPLAY_CHUNK_SIZE = 64
+
+    _FENCE_RE = re.compile(r'^.*```.*(?:\n|$)', re.MULTILINE)
+    _FENCE_BLOCK_RE = re.compile(r'^```[^\n]*\n(.*?)(?:\n```)?\s*\Z', re.DOTALL)
+
+    # 模板的 format 方法只绑定一次
+    _format_generator_question = GENERATOR_USER_PROMPT.format
+    _format_standard_question = STANDARD_USER_PROMPT.format
+
     def __init__(self, api_key, base_url, ai_model):
-        self._client = OpenAI(api_key=api_key, base_url=base_url)
+        self._client = _get_openai(api_key, base_url, current_app.config['AI_TIMEOUT'])
+        self._base_url = base_url
         self._ai_model = ai_model
     
     def _construct_completion(self, system_prompt, user_question, stream: bool = False):
-        return self._client.chat.completions.create(
+        kwargs = {}
+        # 只在配置了上限时发送; 部分模型 (如 o 系列推理模型) 不接受 max_tokens
+        if max_tokens := current_app.config['AI_MAX_TOKENS']:
+            kwargs['max_tokens'] = max_tokens
+        return _create_with_retry(
+            self._client,
             model=self._ai_model,
             messages=[
                 {'role': 'system', 'content': system_prompt},
                 {'role': 'user', 'content': user_question}
             ],
             stream=stream,
-            timeout=current_app.config['AI_TIMEOUT']
+            **kwargs
         )
 
-    def _stream_completion(self, system_prompt, user_question):
+    def _request_stream(self, system_prompt, user_question, finish_reasons=None):
+        start = time.perf_counter()
         stream = self._construct_completion(
             system_prompt,
             user_question,
             stream=True
         )
-        for chunk in stream:
-            delta = chunk.choices[0].delta
-            if (content := getattr(delta, 'content', None)) is not None:
-                yield content
+        yield from _iter_deltas(stream, self._ai_model, start, finish_reasons)
 
-    def generate_generator(self, context):
+    def _stream_completion(self, system_prompt, user_question):
+        cache = get_llm_cache()
+        if cache is not None:
+            key = LLMCache.make_key(self._base_url, self._ai_model, system_prompt, user_question)
+            if (content := cache.get(key)) is not None:
+                # 命中缓存时按小段回放, 保持与真实流式输出相同的接口
+                for i in range(0, len(content), self.CACHE_REPLAY_CHUNK_SIZE):
+                    yield content[i:i + self.CACHE_REPLAY_CHUNK_SIZE]
+                return
+
+        parts = []
+        finish_reasons = []
+        for content in self._request_stream(system_prompt, user_question, finish_reasons):
+            if cache is not None:
+                parts.append(content)
+            yield content
+        # 回复达到输出 token 上限被截断时代码不完整: 不缓存, 并以错误告知调用方
+        if 'length' in finish_reasons:
+            raise APIError('AI response was cut off by the output token limit, the generated code is incomplete')
+        # 只缓存完整结束的回复
+        if cache is not None:
+            cache.set(key, ''.join(parts))
+
+    @staticmethod
+    def _require_description(context):
         if 'description' not in context:
             raise APIError('You must provided problem description')
 
-        return self._construct_completion(
+    @classmethod
+    def _strip_fences(cls, content):
+        """模型偶尔仍会输出 Markdown 代码围栏, 去掉围栏只保留代码"""
+        # 常见情况: 整个回复被一个代码块包裹, 一次匹配取出内部
+        # 内部仍含围栏行 (多个代码块, 或围栏后还有说明文字) 时退回逐行删除围栏
+        if content.startswith('```') and (match := cls._FENCE_BLOCK_RE.match(content)):
+            code = match.group(1)
+            if '```' not in code:
+                return code
+        return cls._FENCE_RE.sub('', content).rstrip('\n')
+
+    def _collect_completion(self, system_prompt, user_question):
+        # 内部仍以流式请求, 避免长输出在等待完整响应时触发读超时
+        content = ''.join(self._stream_completion(system_prompt, user_question))
+        return self._strip_fences(content)
+
+    def generate_generator(self, context):
+        self._require_description(context)
+        return self._collect_completion(
             self.GENERATOR_SYSTEM_PROMPT,
-            self.GENERATOR_USER_PROMPT.format(context['description'])
+            self._format_generator_question(context['description'])
         )
 
     def generate_standard(self, context):
-        if 'description' not in context:
-            raise APIError('You must provided problem description')
-
-        return self._construct_completion(
+        self._require_description(context)
+        return self._collect_completion(
             self.STANDARD_SYSTEM_PROMPT,
-            self.STANDARD_USER_PROMPT.format(context['description'])
+            self._format_standard_question(context['description'])
         )
 
     def generate_generator_stream(self, context):
-        if 'description' not in context:
-            raise APIError('You must provided problem description')
-
-        return self._stream_completion(
+        self._require_description(context)
+        return _batch_deltas(self._stream_completion(
             self.GENERATOR_SYSTEM_PROMPT,
-            self.GENERATOR_USER_PROMPT.format(context['description'])
-        )
+            self._format_generator_question(context['description'])
+        ))
 
     def generate_standard_stream(self, context):
-        if 'description' not in context:
-            raise APIError('You must provided problem description')
-
-        return self._stream_completion(
+        self._require_description(context)
+        return _batch_deltas(self._stream_completion(
             self.STANDARD_SYSTEM_PROMPT,
-            self.STANDARD_USER_PROMPT.format(context['description'])
-        )
+            self._format_standard_question(context['description'])
+        ))
 
 
 class OCRClient:
@@ -154,14 +339,32 @@ class OCRClient:
 Extract the original programming problem description from the provided image, which may be in Chinese or English. Output the content strictly in markdown format, preserving all expressions and the original language. If no programming problem description is found in the image, respond with 'Problem description not found' only.
 """
     def __init__(self, api_key, base_url, ai_model) -> None:
-        self._client = OpenAI(api_key=api_key, base_url=base_url)
+        self._client = _get_openai(api_key, base_url, current_app.config['AI_TIMEOUT'])
         self._ai_model = ai_model
     
+    # 与 Pillow 默认值一致; 更高的质量只会增大上传体积, 对识别没有帮助
+    JPEG_QUALITY = 75
+    # 视觉模型按图片面积计费, 长边超过该值时先等比缩小
+    MAX_EDGE = 1568
+
     @classmethod
     def _get_data_url(cls, image: Image):
+        # 先转为 RGB 再缩放: 调色板 ("P") 和 "1" 模式下 Pillow 会忽略 LANCZOS 改用 NEAREST, 文字会出现锯齿
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        width, height = image.size
+        scale = min(1.0, cls.MAX_EDGE / max(width, height))
+        if scale < 1.0:
+            image = image.resize(
+                (max(1, int(width * scale)), max(1, int(height * scale))),
+                Image.Resampling.LANCZOS
+            )
         buffer = io.BytesIO()
-        image.convert('RGB').save(buffer, format='JPEG')
-        return 'data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode('utf-8')
+        image.save(buffer, format='JPEG', quality=cls.JPEG_QUALITY, optimize=False)
+        # getbuffer() 直接暴露内部缓冲区, 省去 getvalue() 的一次完整拷贝
+        with buffer.getbuffer() as view:
+            encoded = base64.b64encode(view)
+        return 'data:image/jpeg;base64,' + encoded.decode('ascii')
     
     def _construct_completion(self, image: Image, stream: bool = False):
         messages = [
@@ -173,20 +376,20 @@ Extract the original programming problem description from the provided image, wh
                 }
             ]}
         ]
-        return self._client.chat.completions.create(
+        return _create_with_retry(
+            self._client,
             model=self._ai_model,
             messages=messages,
-            stream=stream,
-            timeout=current_app.config['AI_TIMEOUT']
+            stream=stream
         )
     
+    def _stream_ocr(self, image: Image):
+        start = time.perf_counter()
+        stream = self._construct_completion(image, stream=True)
+        yield from _iter_deltas(stream, self._ai_model, start)
+
     def perform_ocr(self, image: Image):
-        completion = self._construct_completion(image)
-        return completion.choices[0].message.content
+        return ''.join(self._stream_ocr(image))
 
     def perform_ocr_stream(self, image: Image):
-        stream = self._construct_completion(image, stream=True)
-        for chunk in stream:
-            delta = chunk.choices[0].delta
-            if (content := getattr(delta, 'content', None)) is not None:
-                yield content
+        return _batch_deltas(self._stream_ocr(image))
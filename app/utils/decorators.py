@@ -2,12 +2,14 @@ from functools import wraps
 from flask_login import current_user
 from app.exceptions import AuthorizationError
 
+_ADMIN_ROLES = frozenset(('admin', 'root'))
+
 def admin_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if not current_user.is_authenticated:
             raise AuthorizationError("Authentication required")
-        if current_user.role not in ['admin', 'root']:
+        if current_user.role not in _ADMIN_ROLES:
             raise AuthorizationError("Admin privileges required")
         return f(*args, **kwargs)
     return decorated_function
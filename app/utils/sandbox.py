@@ -2,10 +2,17 @@ from app.exceptions import SandboxError
 from signal import Signals
 import os
 import ctypes
+import hashlib
+import select
+import selectors
+import shutil
+import stat
+import subprocess
+from functools import lru_cache
 from pathlib import Path
+from typing import NamedTuple
 from flask import current_app
-from subprocess import Popen, PIPE
-from multiprocessing import Pipe
+from subprocess import Popen, PIPE, DEVNULL
 
 class ChildData(ctypes.Structure):
     _fields_ = [
@@ -15,6 +22,74 @@ class ChildData(ctypes.Structure):
         ('memory_kb', ctypes.c_uint64),
     ]
 
+class _SandboxConfig(NamedTuple):
+    """沙箱相关配置的快照, 每个应用只构建一次, 限制都已换算为字节"""
+    testlib_path: str
+    compiler_limits: tuple[int, int, int]  # (CPU 秒, 内存字节, 输出字节)
+    prog_limits: tuple[int, int, int]
+    compile_cache_dir: Path | None
+    compile_cache_size: int
+    bwrap_prefix: tuple[str, ...]  # 每次启动都相同的 bwrap 参数
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            testlib_path=config['TESTLIB_PATH'],
+            compiler_limits=(
+                config['COMPILER_TIME_LIMIT'],
+                config['COMPILER_MEMORY_LIMIT'] * 1024 * 1024,
+                config['COMPILER_OUTPUT_LIMIT'] * 1024,
+            ),
+            prog_limits=(
+                config['PROG_TIME_LIMIT'],
+                config['PROG_MEMORY_LIMIT'] * 1024 * 1024,
+                config['PROG_OUTPUT_LIMIT'] * 1024,
+            ),
+            compile_cache_dir=_private_cache_dir(config['COMPILE_CACHE_DIR']),
+            compile_cache_size=config['COMPILE_CACHE_SIZE'],
+            bwrap_prefix=(
+                config['SANDBOX_EXECUTABLE'],
+                '--ro-bind', config['RLIMIT_WRAPPER_EXECUTABLE'], '/wrapper',
+                '--ro-bind', '/usr', '/usr',
+                '--symlink', 'usr/lib', '/lib',
+                '--symlink', 'usr/lib64', '/lib64',
+                '--proc', '/proc',
+                '--dev', '/dev',
+                '--dir', '/home',
+                '--chdir', '/home',
+                '--unshare-all',
+                '--as-pid-1',
+            ),
+        )
+
+def _private_cache_dir(path) -> Path | None:
+    """
+    准备编译缓存目录, 不存在时以 0700 创建
+
+    缓存中的可执行文件会被直接运行, 目录若不属于当前用户、对其他用户可写或是符号链接,
+    就可能被植入文件, 此时关闭缓存
+    """
+    if not path:
+        return None
+    path = Path(path)
+    try:
+        path.mkdir(mode=0o700, parents=True, exist_ok=True)
+        st = path.lstat()
+    except OSError as e:
+        current_app.logger.warning(f"Compile cache disabled: cannot create {path}: {e}")
+        return None
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.geteuid() or st.st_mode & 0o077:
+        current_app.logger.warning(f"Compile cache disabled: {path} must be a directory owned by this user with mode 0700")
+        return None
+    return path
+
+def _get_config() -> _SandboxConfig:
+    """获取当前应用的沙箱配置快照"""
+    cfg = current_app.extensions.get('sandbox')
+    if cfg is None:
+        cfg = current_app.extensions.setdefault('sandbox', _SandboxConfig.from_config(current_app.config))
+    return cfg
+
 def get_result_from_exit_status(exit_status):
     if os.WIFEXITED(exit_status):
         return {'type': 'OK', 'code': os.WEXITSTATUS(exit_status)}
@@ -31,64 +106,181 @@ def get_result_from_exit_status(exit_status):
     else:
         return {'type': 'UKE', 'code': exit_status}
 
-def launch_sandbox(cmd, rlim_cpu, rlim_as, rlim_fsz, extra_args=[], input_data = None) -> tuple[ChildData, str, str]:
+def _communicate(child: Popen, input_data: bytes | None, limit: int) -> tuple[str, str, bool]:
+    """
+    与子进程交互: 写入 stdin, 同时读取 stdout/stderr
+
+    RLIMIT_FSIZE 对管道不生效, 因此这里对每个输出流最多保留 limit 字节, 超出部分读出后直接丢弃,
+    避免把不受限制的输出整个读进内存。返回的第三项表示 stdout 是否被截断;
+    stderr 只做截断 (常见的调试输出), 不计入输出超限。
+    """
+    buffers = {child.stdout: bytearray(), child.stderr: bytearray()}
+    stdout_truncated = False
+
+    with selectors.DefaultSelector() as selector:
+        selector.register(child.stdout, selectors.EVENT_READ)
+        selector.register(child.stderr, selectors.EVENT_READ)
+        if input_data:
+            input_view = memoryview(input_data).cast('B')
+            input_offset = 0
+            selector.register(child.stdin, selectors.EVENT_WRITE)
+        elif child.stdin is not None:
+            child.stdin.close()
+
+        while selector.get_map():
+            for key, _ in selector.select():
+                file = key.fileobj
+                if file is child.stdin:
+                    try:
+                        input_offset += os.write(file.fileno(), input_view[input_offset:input_offset + select.PIPE_BUF])
+                    except BrokenPipeError:
+                        input_offset = len(input_view)
+                    if input_offset >= len(input_view):
+                        selector.unregister(file)
+                        file.close()
+                else:
+                    data = os.read(file.fileno(), 65536)
+                    if not data:
+                        selector.unregister(file)
+                        file.close()
+                        continue
+                    buffer = buffers[file]
+                    room = limit - len(buffer)
+                    if room > 0:
+                        buffer += data[:room]
+                    if len(data) > room and file is child.stdout:
+                        stdout_truncated = True
+
+    child.wait()
+    stdout = buffers[child.stdout].decode(errors='replace')
+    stderr = buffers[child.stderr].decode(errors='replace')
+    return stdout, stderr, stdout_truncated
+
+def launch_sandbox(cmd, rlim_cpu, rlim_as, rlim_fsz, extra_args=(), input_data = None) -> tuple[ChildData, str, str, bool]:
+    """
+    input_data 可以是 str, bytes / memoryview (直接写入, 不再复制),
+    或带 fileno() 的文件对象 (直接作为子进程的 stdin, 数据不经过 Python)
+    """
+    if isinstance(input_data, str):
+        input_data = input_data.encode()
+    if hasattr(input_data, 'fileno'):
+        stdin, input_data = input_data, None
+    else:
+        stdin = PIPE
+
     pipe_rd_fd, pipe_wr_fd = os.pipe()
     with os.fdopen(pipe_wr_fd, 'wb') as pipe_wr, os.fdopen(pipe_rd_fd, 'rb') as pipe_rd:
+        sync_fd = str(pipe_wr_fd)
         child = Popen(
             [
-                current_app.config['SANDBOX_EXECUTABLE'],
-                '--ro-bind', current_app.config['RLIMIT_WRAPPER_EXECUTABLE'], '/wrapper',
-                '--ro-bind', '/usr', '/usr',
-                '--symlink', 'usr/lib', '/lib',
-                '--symlink', 'usr/lib64', '/lib64',
-                '--proc', '/proc',
-                '--dev', '/dev',
-                '--dir', '/home',
-                '--chdir', '/home',
-                '--unshare-all',
-                '--as-pid-1',
-                '--sync-fd', str(pipe_wr.fileno()),
+                *_get_config().bwrap_prefix,
+                '--sync-fd', sync_fd,
                 *extra_args,
-                '--', '/wrapper', str(rlim_cpu), str(rlim_as), str(rlim_fsz), str(pipe_wr.fileno()),
+                '--', '/wrapper', str(rlim_cpu), str(rlim_as), str(rlim_fsz), sync_fd,
                 *cmd
             ],
-            pass_fds=[pipe_wr.fileno()],
+            pass_fds=[pipe_wr_fd],
             stdout=PIPE,
             stderr=PIPE,
-            stdin=PIPE,
+            stdin=stdin,
         )
         pipe_wr.close()
 
-        stdout, stderr = child.communicate(None if input_data is None else input_data.encode())
-        if isinstance(stderr, bytes):
-            stderr = stderr.decode()
-        if isinstance(stdout, bytes):
-            stdout = stdout.decode()
+        stdout, stderr, stdout_truncated = _communicate(child, input_data, rlim_fsz)
 
-        data_buf = pipe_rd.read(ctypes.sizeof(ChildData))
-        try:
-            data = ChildData.from_buffer_copy(data_buf)
-        except ValueError as e:
+        # 直接读入预分配的结构体, 省去中间 bytes 和一次拷贝
+        data = ChildData()
+        data_size = pipe_rd.readinto(memoryview(data).cast('B'))
+        if data_size != ctypes.sizeof(ChildData):
             current_app.logger.error(f"Sandbox execution failed. stderr: {stderr}")
             current_app.logger.error(f"Sandbox stdout: {stdout}")
-            current_app.logger.error(f"Data buffer size: {len(data_buf)}")
-            raise SandboxError(f"Sandbox failed to return valid data: {e}. stderr: {stderr}")
+            current_app.logger.error(f"Data buffer size: {data_size}")
+            raise SandboxError(f"Sandbox failed to return valid data: short read ({data_size} bytes). stderr: {stderr}")
+
+    return data, stdout, stderr, stdout_truncated
+
+@lru_cache(maxsize=None)
+def _compiler_version(compiler: str) -> str:
+    """编译器版本信息, 作为编译缓存键的一部分, 升级编译器后旧缓存自然失效"""
+    try:
+        return subprocess.run([compiler, '--version'], capture_output=True, text=True).stdout.partition('\n')[0]
+    except OSError:
+        return ''
+
+@lru_cache(maxsize=8)
+def _digest_files(signature: tuple) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for path, _, _ in signature:
+        h.update(path.encode())
+        h.update(Path(path).read_bytes())
+    return h.hexdigest()
+
+def _testlib_digest(testlib_path: str) -> str:
+    """testlib.h 及其预编译头的内容摘要; 按文件大小与 mtime 缓存, 文件更新后重新计算"""
+    gch = Path(testlib_path + '.gch')
+    paths = [Path(testlib_path), *(sorted(p for p in gch.rglob('*') if p.is_file()) if gch.is_dir() else ())]
+    signature = []
+    for path in paths:
+        try:
+            st = path.stat()
+        except OSError:
+            continue
+        signature.append((str(path), st.st_size, st.st_mtime_ns))
+    return _digest_files(tuple(signature))
+
+def _compile_cache_key(code, lang: str, std: str, optimize_level: int, compiler: str, testlib_path: str) -> str:
+    h = hashlib.blake2b(Path(code).read_bytes(), digest_size=16)
+    h.update(f'|{lang}|{std}|{optimize_level}|{_compiler_version(compiler)}|{_testlib_digest(testlib_path)}'.encode())
+    return h.hexdigest()
+
+def _load_compiled(cache_dir: Path, key: str, out) -> str | None:
+    """命中时把缓存的可执行文件复制到 out 并返回当时的编译器输出, 未命中返回 None"""
+    exe = cache_dir / key
+    try:
+        shutil.copy(exe, out)
+        stderr = (cache_dir / f'{key}.stderr').read_text()
+        # 更新 mtime, 淘汰时按 mtime 近似 LRU
+        exe.touch()
+    except OSError:
+        return None
+    return stderr
 
-    return data, stdout, stderr
+def _store_compiled(cache_dir: Path, key: str, out, stderr: str, max_entries: int):
+    # 先写临时文件再 rename, 并发编译同一份代码时不会读到写了一半的文件
+    tmp = cache_dir / f'.{key}-{os.getpid()}-{os.urandom(4).hex()}'
+    tmp.write_text(stderr)
+    os.replace(tmp, cache_dir / f'{key}.stderr')
+    shutil.copy(out, tmp)
+    os.replace(tmp, cache_dir / key)
+
+    entries = [p for p in cache_dir.iterdir() if not p.name.startswith('.') and not p.suffix]
+    if len(entries) > max_entries:
+        entries.sort(key=lambda p: p.stat().st_mtime)
+        for p in entries[:len(entries) - max_entries]:
+            p.unlink(missing_ok=True)
+            p.with_suffix('.stderr').unlink(missing_ok=True)
 
 def run_compiler(code: str, out: str, lang: str, std: str, optimize_level: int = 2):
-    time_limit = current_app.config['COMPILER_TIME_LIMIT']
-    memory_limit = current_app.config['COMPILER_MEMORY_LIMIT'] * 1024 * 1024
-    output_limit = current_app.config['COMPILER_OUTPUT_LIMIT'] * 1024
+    cfg = _get_config()
+    time_limit, memory_limit, output_limit = cfg.compiler_limits
 
     if lang.lower() == 'c':
-        cmd = ['gcc', '-x', 'c', f'-std={std}', f'-O{optimize_level}', 'code', '-o', 'out']
+        compiler = 'gcc'
+        cmd = [compiler, '-x', 'c', f'-std={std}', f'-O{optimize_level}', 'code', '-o', 'out']
     elif lang.lower() == 'cpp':
-        cmd = ['g++', '-x', 'c++', f'-std={std}', f'-O{optimize_level}', 'code', '-o', 'out']
+        compiler = 'g++'
+        cmd = [compiler, '-x', 'c++', f'-std={std}', f'-O{optimize_level}', 'code', '-o', 'out']
     else:
         raise SandboxError("Unknown language")
 
-    data, stdout, stderr = launch_sandbox(
+    cache_dir = cfg.compile_cache_dir
+    if cache_dir:
+        key = _compile_cache_key(code, lang.lower(), std, optimize_level, compiler, cfg.testlib_path)
+        stderr = _load_compiled(cache_dir, key, out)
+        if stderr is not None:
+            return 'status', {'message': "Success", 'detail': stderr[:1024]}
+
+    data, stdout, stderr, _ = launch_sandbox(
         cmd,
         time_limit,
         memory_limit,
@@ -96,8 +288,8 @@ def run_compiler(code: str, out: str, lang: str, std: str, optimize_level: int =
         extra_args=[
             '--ro-bind', code, '/home/code',
             '--bind', out, '/home/out',
-            '--ro-bind', current_app.config['TESTLIB_PATH'], '/home/testlib.h',
-            '--ro-bind', current_app.config['TESTLIB_PATH'] + '.gch/', '/home/testlib.h.gch/',
+            '--ro-bind', cfg.testlib_path, '/home/testlib.h',
+            '--ro-bind', cfg.testlib_path + '.gch/', '/home/testlib.h.gch/',
         ]
     )
 
@@ -107,15 +299,18 @@ def run_compiler(code: str, out: str, lang: str, std: str, optimize_level: int =
     elif res['type'] != 'OK':
         return 'failed', {'message': f"Compiler {res['type']}", 'detail': ""}
     else:
+        if cache_dir:
+            try:
+                _store_compiled(cache_dir, key, out, stderr, cfg.compile_cache_size)
+            except OSError as e:
+                current_app.logger.warning(f"Failed to cache compiled binary: {e}")
         return 'status', {'message': "Success", 'detail': stderr[:1024]}
 
 def run_checker(checker, input_file, output_file, answer_file):
-    child = Popen([checker, input_file, output_file, answer_file], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = child.communicate()
-    if isinstance(stderr, bytes):
-        stderr = stderr.decode()
-    if isinstance(stdout, bytes):
-        stdout = stdout.decode()
+    # checker 的结论只看 stderr, stdin/stdout 直接接到 /dev/null, 不再多开两条管道
+    child = Popen([checker, input_file, output_file, answer_file], stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE)
+    _, stderr = child.communicate()
+    stderr = stderr.decode()
 
     res = get_result_from_exit_status(child.returncode)
     if res['code'] == 1:
@@ -125,12 +320,10 @@ def run_checker(checker, input_file, output_file, answer_file):
     else:
         return {'status': 'OK', 'detail': stderr}
 
-def run_program(filename, args = [], input_data = None) -> tuple[dict, str, str, float, float]:
-    time_limit = current_app.config['PROG_TIME_LIMIT']
-    memory_limit = current_app.config['PROG_MEMORY_LIMIT'] * 1024 * 1024
-    output_limit = current_app.config['PROG_OUTPUT_LIMIT'] * 1024
+def run_program(filename, args = (), input_data = None) -> tuple[dict, str, str, float, float]:
+    time_limit, memory_limit, output_limit = _get_config().prog_limits
 
-    data, stdout, stderr = launch_sandbox(
+    data, stdout, stderr, stdout_truncated = launch_sandbox(
         ['/exe', *args],
         time_limit,
         memory_limit,
@@ -142,5 +335,8 @@ def run_program(filename, args = [], input_data = None) -> tuple[dict, str, str,
     time_ms = data.user_time_us / 1000
     memory_mb = data.memory_kb / 1024
     result = get_result_from_exit_status(data.exit_status)
+    if stdout_truncated and result['type'] == 'OK':
+        # 输出写入管道时 RLIMIT_FSIZE 不会触发 SIGXFSZ, stdout 超出限制时按输出超限处理
+        result = {'type': 'OLE', 'code': Signals.SIGXFSZ}
 
     return result, stdout, stderr, time_ms, memory_mb
@@ -0,0 +1,90 @@
+from contextlib import contextmanager
+from flask import current_app
+import queue
+import smtplib
+
+
+class SMTPPool:
+    """
+    SMTP 连接池
+
+    复用已登录的连接, 省去每封邮件的 TLS 握手与 LOGIN 往返;
+    取出空闲连接时先用 NOOP 检查, 失效则重新建立。最多保留 size 个空闲连接
+    """
+
+    def __init__(self, host, port, use_tls=False, username=None, password=None, size=4):
+        self._host = host
+        self._port = port
+        self._use_tls = use_tls
+        self._username = username
+        self._password = password
+        self._idle: queue.Queue[smtplib.SMTP] = queue.Queue(maxsize=size)
+
+    def _connect(self) -> smtplib.SMTP:
+        if self._use_tls:
+            smtp = smtplib.SMTP_SSL(self._host, self._port)
+            if self._username and self._password:
+                smtp.login(self._username, self._password)
+        else:
+            smtp = smtplib.SMTP(self._host, self._port)
+            if self._username and self._password:
+                smtp.starttls()
+                smtp.login(self._username, self._password)
+        return smtp
+
+    @staticmethod
+    def _is_alive(smtp: smtplib.SMTP) -> bool:
+        try:
+            return smtp.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    @staticmethod
+    def _close(smtp: smtplib.SMTP):
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+
+    def _acquire(self) -> smtplib.SMTP:
+        while True:
+            try:
+                smtp = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if self._is_alive(smtp):
+                return smtp
+            self._close(smtp)
+
+    def _release(self, smtp: smtplib.SMTP):
+        try:
+            self._idle.put_nowait(smtp)
+        except queue.Full:
+            self._close(smtp)
+
+    @contextmanager
+    def connection(self):
+        """取出一个可用连接; 使用中出错的连接直接关闭, 不放回池中"""
+        smtp = self._acquire()
+        try:
+            yield smtp
+        except BaseException:
+            self._close(smtp)
+            raise
+        self._release(smtp)
+
+
+def get_smtp_pool() -> SMTPPool:
+    """获取当前应用的 SMTP 连接池"""
+    pool = current_app.extensions.get('smtp_pool')
+    if pool is None:
+        config = current_app.config
+        pool = current_app.extensions.setdefault('smtp_pool', SMTPPool(
+            config['MAIL_SERVER'],
+            config['MAIL_PORT'],
+            use_tls=config['MAIL_USE_TLS'],
+            username=config['MAIL_USERNAME'],
+            password=config['MAIL_PASSWORD'],
+            size=config['MAIL_POOL_SIZE'],
+        ))
+    return pool
@@ -1,9 +1,31 @@
+import heapq
+import itertools
 import json
 import logging
+import threading
+from collections import defaultdict
 from datetime import datetime
+import time
+
+def _json_dumps(data) -> bytes:
+    # 紧凑格式, 减少写入的字节数
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode()
 
 logger = logging.getLogger(__name__)
 
+# 事件类型只有少数几种, 预先生成 "event: xxx\ndata: " 前缀
+_EVENT_PREFIXES = {
+    event_type: f'event: {event_type}\ndata: '.encode()
+    for event_type in ('status', 'failed', 'test_result', 'finish', 'error', 'chunk', 'heartbeat', 'completed')
+}
+_END = b'\n\n'
+
+def _event_prefix(event_type):
+    prefix = _EVENT_PREFIXES.get(event_type)
+    if prefix is None:
+        prefix = _EVENT_PREFIXES.setdefault(event_type, f'event: {event_type}\ndata: '.encode())
+    return prefix
+
 def sse_response(event_type, data, event_id=None):
     """
     格式化 SSE (Server-Sent Events) 响应
@@ -14,24 +36,38 @@ def sse_response(event_type, data, event_id=None):
         event_id: 事件ID (可选)
     
     Returns:
-        格式化的 SSE 字符串
+        格式化的 SSE 字节串, 可直接写入响应流
     """
     # 添加时间戳
     data['timestamp'] = datetime.utcnow().isoformat()
     
-    response = []
-    
-    if event_id:
-        response.append(f'id: {event_id}')
-    
-    response.append(f'event: {event_type}')
-    response.append(f'data: {json.dumps(data, ensure_ascii=False)}')
-    response.append('\n')  # 空行表示事件结束
-    
-    return '\n'.join(response)
+    event = _event_prefix(event_type) + _json_dumps(data) + _END
+    if event_id is not None:
+        event = b'id: ' + str(event_id).encode() + b'\n' + event
+    return event
+
+def sse_chunk(content):
+    """
+    生成流式输出片段事件, 与 sse_response('chunk', {'content': content}) 输出一致
+
+    该事件在 AI 流式输出时高频发送, 因此只对 content 做 JSON 编码, 其余部分直接拼接
+    """
+    return b''.join((
+        b'event: chunk\ndata: {"content":',
+        _json_dumps(content),
+        b',"timestamp":"', datetime.utcnow().isoformat().encode(), b'"}\n\n'
+    ))
 
 def sse_error(message, details=None, code=500):
     """生成错误 SSE 事件"""
+    if not details and type(code) is int:
+        # 结构固定, 只对 message 做 JSON 编码
+        return b''.join((
+            b'event: error\ndata: {"error":true,"message":',
+            _json_dumps(message),
+            b',"code":%d,"timestamp":"%s"}\n\n' % (code, datetime.utcnow().isoformat().encode())
+        ))
+
     data = {
         'error': True,
         'message': message,
@@ -44,6 +80,16 @@ def sse_error(message, details=None, code=500):
 
 def sse_completed(total=None, success=None, fail=None, reason=None):
     """生成完成 SSE 事件"""
+    counts = (('total', total), ('success', success), ('fail', fail))
+    if not reason and all(value is None or type(value) is int for _, value in counts):
+        # 只含整数字段时直接拼接, 不经过 JSON 编码器
+        parts = [b'event: completed\ndata: {"status":"completed"']
+        for key, value in counts:
+            if value is not None:
+                parts.append(b',"%s":%d' % (key.encode(), value))
+        parts.append(b',"timestamp":"%s"}\n\n' % datetime.utcnow().isoformat().encode())
+        return b''.join(parts)
+
     data = {
         'status': 'completed'
     }
@@ -58,56 +104,98 @@ def sse_completed(total=None, success=None, fail=None, reason=None):
     
     return sse_response('completed', data)
 
+_HEARTBEAT_PREFIX = b'event: heartbeat\ndata: {"message":"Connection alive","timestamp":"'
+_HEARTBEAT_SUFFIX = b'"}\n\n'
+
 def sse_heartbeat():
-    """生成心跳事件 (保持连接活跃)"""
-    return sse_response('heartbeat', {'message': 'Connection alive'})
+    """生成心跳事件 (保持连接活跃), 内容固定, 只拼接时间戳"""
+    return _HEARTBEAT_PREFIX + datetime.utcnow().isoformat().encode() + _HEARTBEAT_SUFFIX
+
+_HEARTBEAT_INTERVAL = 30  # 秒
+_STALE_TIMEOUT = 300  # 5分钟
 
 class SSEManager:
     """SSE 连接管理器"""
     
     def __init__(self):
-        self.connections = {}
+        self.connections = defaultdict(dict)
+        # 每个会话的 (client_id, conn) 元组快照, 注册/注销时重建, 广播时直接遍历
+        self.conn_lists = {}
+        # 每个会话的事件序号, 作为 SSE 事件 id
+        self._seq = defaultdict(int)
+        # 保护 connections / conn_lists / _seq 的修改; 请求线程与心跳线程并发访问
+        self._lock = threading.Lock()
+        # 心跳调度: (到期时间, 序号, session_id, client_id, conn) 小顶堆, 由后台线程按到期时间唤醒
+        self._heartbeat_heap = []
+        self._heartbeat_order = itertools.count()
+        self._heartbeat_cond = threading.Condition()
+        self._heartbeat_thread = None
         self.logger = logging.getLogger('sse.manager')
     
     def register_connection(self, session_id, client_id, stream):
         """注册新连接"""
-        if session_id not in self.connections:
-            self.connections[session_id] = {}
-        
-        self.connections[session_id][client_id] = {
+        # created_at 用于日志展示, last_heartbeat 只用于计算间隔; 两个时钟各读一次
+        now = time.monotonic()
+        conn = {
             'stream': stream,
             'created_at': datetime.utcnow(),
-            'last_heartbeat': datetime.utcnow()
+            'last_heartbeat': now,
+            # 串行化对同一个流的写入, 避免广播与心跳交错输出半个事件
+            'lock': threading.Lock()
         }
+        with self._lock:
+            session = self.connections[session_id]
+            session[client_id] = conn
+            self.conn_lists[session_id] = tuple(session.items())
+        # 在注册锁之外登记心跳, 两把锁不嵌套
+        self._schedule_heartbeat(now + _HEARTBEAT_INTERVAL, session_id, client_id, conn)
         
-        self.logger.info(f'Registered SSE connection: session={session_id}, client={client_id}')
+        self.logger.debug(f'Registered SSE connection: session={session_id}, client={client_id}')
         return True
     
     def unregister_connection(self, session_id, client_id):
         """注销连接"""
-        if session_id in self.connections and client_id in self.connections[session_id]:
-            del self.connections[session_id][client_id]
-            if not self.connections[session_id]:
+        with self._lock:
+            # 用 get 而不是下标访问, 避免 defaultdict 为不存在的会话创建空字典
+            session = self.connections.get(session_id)
+            if session is None:
+                return False
+            try:
+                del session[client_id]
+            except KeyError:
+                return False
+
+            if not session:
                 del self.connections[session_id]
-            
-            self.logger.info(f'Unregistered SSE connection: session={session_id}, client={client_id}')
-            return True
-        return False
+                del self.conn_lists[session_id]
+                self._seq.pop(session_id, None)
+            else:
+                self.conn_lists[session_id] = tuple(session.items())
+        
+        self.logger.debug(f'Unregistered SSE connection: session={session_id}, client={client_id}')
+        return True
     
     def broadcast_event(self, session_id, event_type, data):
         """向会话的所有客户端广播事件"""
-        if session_id not in self.connections:
+        conns = self.conn_lists.get(session_id)
+        if not conns:
             return 0
         
         success_count = 0
         failed_clients = []
+        now = time.monotonic()
+        # 事件内容与客户端无关, 只序列化一次, 所有客户端共用同一份字节
+        with self._lock:
+            seq = self._seq[session_id]
+            self._seq[session_id] = seq + 1
+        event = sse_response(event_type, data, event_id=seq)
         
-        for client_id, conn in list(self.connections[session_id].items()):
+        for client_id, conn in conns:
             try:
-                event = sse_response(event_type, data, event_id=f"{session_id}-{client_id}-{int(datetime.utcnow().timestamp())}")
-                conn['stream'].write(event)
-                conn['stream'].flush()
-                conn['last_heartbeat'] = datetime.utcnow()
+                with conn['lock']:
+                    conn['stream'].write(event)
+                    conn['stream'].flush()
+                conn['last_heartbeat'] = now
                 success_count += 1
             except Exception as e:
                 self.logger.warning(f'Failed to send event to client {client_id}: {str(e)}')
@@ -119,27 +207,68 @@ class SSEManager:
         
         return success_count
     
-    def send_heartbeat(self):
-        """发送心跳到所有活跃连接"""
-        now = datetime.utcnow()
-        for session_id in list(self.connections.keys()):
-            for client_id, conn in list(self.connections[session_id].items()):
-                # 检查连接是否超时
-                if (now - conn['last_heartbeat']).total_seconds() > 300:  # 5分钟
+    def _schedule_heartbeat(self, due, session_id, client_id, conn):
+        """登记下一次心跳, 首次调用时启动后台心跳线程"""
+        with self._heartbeat_cond:
+            heapq.heappush(self._heartbeat_heap, (due, next(self._heartbeat_order), session_id, client_id, conn))
+            if self._heartbeat_thread is None:
+                self._heartbeat_thread = threading.Thread(target=self._heartbeat_loop, name='sse-heartbeat', daemon=True)
+                self._heartbeat_thread.start()
+            self._heartbeat_cond.notify()
+
+    def _pop_due_heartbeats(self):
+        """睡眠到最早的心跳到期, 取出所有已到期的条目"""
+        with self._heartbeat_cond:
+            while True:
+                now = time.monotonic()
+                heap = self._heartbeat_heap
+                if heap and heap[0][0] <= now:
+                    due = []
+                    while heap and heap[0][0] <= now:
+                        due.append(heapq.heappop(heap))
+                    return now, due
+                self._heartbeat_cond.wait(heap[0][0] - now if heap else None)
+
+    def _heartbeat_loop(self):
+        while True:
+            now, due = self._pop_due_heartbeats()
+            heartbeat = None
+            dead = []
+            for _, _, session_id, client_id, conn in due:
+                # 连接已注销 (或以同一 client_id 重新注册) 时直接丢弃该条目
+                with self._lock:
+                    active = self.connections.get(session_id, {}).get(client_id) is conn
+                if not active:
+                    continue
+
+                # 期间发送过广播事件, 顺延到下一个周期
+                last_heartbeat = conn['last_heartbeat']
+                next_due = last_heartbeat + _HEARTBEAT_INTERVAL
+                if next_due > now:
+                    self._schedule_heartbeat(next_due, session_id, client_id, conn)
+                    continue
+
+                # 检查连接是否超时 (长时间没有任何成功写入)
+                if last_heartbeat < now - _STALE_TIMEOUT:
                     self.logger.info(f'Closing stale SSE connection: session={session_id}, client={client_id}')
-                    self.unregister_connection(session_id, client_id)
+                    dead.append((session_id, client_id))
                     continue
-                
-                # 每30秒发送一次心跳
-                if (now - conn['last_heartbeat']).total_seconds() > 30:
-                    try:
-                        event = sse_heartbeat()
-                        conn['stream'].write(event)
+
+                try:
+                    if heartbeat is None:
+                        heartbeat = sse_heartbeat()
+                    with conn['lock']:
+                        conn['stream'].write(heartbeat)
                         conn['stream'].flush()
-                        conn['last_heartbeat'] = now
-                    except Exception as e:
-                        self.logger.warning(f'Failed to send heartbeat to client {client_id}: {str(e)}')
-                        self.unregister_connection(session_id, client_id)
+                    conn['last_heartbeat'] = now
+                except Exception as e:
+                    self.logger.warning(f'Failed to send heartbeat to client {client_id}: {str(e)}')
+                    dead.append((session_id, client_id))
+                else:
+                    self._schedule_heartbeat(now + _HEARTBEAT_INTERVAL, session_id, client_id, conn)
+
+            for session_id, client_id in dead:
+                self.unregister_connection(session_id, client_id)
 
 # 全局 SSE 管理器实例
 sse_manager = SSEManager()
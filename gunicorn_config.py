@@ -1,5 +1,13 @@
 bind = "unix:myapp.sock"
 workers = 3  # 核心数 * 2 + 1
-worker_class = "sync"
+# SSE 流 (AI 生成, 对拍) 会长时间占用连接, 使用线程 worker 使其只占一个线程而非整个进程
+worker_class = "gthread"
+threads = 8
 timeout = 120
 keepalive = 5
+
+
+def post_fork(server, worker):
+    # 日志监听线程不会随 fork 带入 worker (preload_app 时应用已在主进程导入), 在每个 worker 中重新配置
+    from run import setup_logging
+    setup_logging()
@@ -1,24 +1,68 @@
 import os
 import sys
+import atexit
 import logging
+import logging.handlers
+import queue
 from app import create_app
 
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
+_LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+_log_listener = None
+_log_pid = None
+
+
+def setup_logging():
+    """
+    配置当前进程的日志
+
+    请求线程只把日志记录放进队列, 由后台线程写终端和文件, 避免磁盘 I/O 阻塞请求。
+    监听线程不会随 fork 带入子进程, 每个 gunicorn worker 需各自调用 (见 gunicorn_config.post_fork)
+    """
+    global _log_listener, _log_pid
+    if _log_pid == os.getpid():
+        return
+
+    log_queue = queue.SimpleQueue()
+    _log_listener = logging.handlers.QueueListener(
+        log_queue,
         logging.StreamHandler(sys.stdout),
-        logging.FileHandler('codediff.log')
-    ]
-)
+        # 多个 worker 进程以追加方式写同一个文件, 不能各自轮转; 轮转交给外部 logrotate,
+        # WatchedFileHandler 发现文件被移走后会重新打开
+        logging.handlers.WatchedFileHandler('codediff.log'),
+    )
+    _log_listener.start()
+    _log_pid = os.getpid()
+
+    # force: 替换从父进程继承的处理器, 否则 basicConfig 不生效
+    logging.basicConfig(
+        level=logging.INFO,
+        format=_LOG_FORMAT,
+        handlers=[logging.handlers.QueueHandler(log_queue)],
+        force=True
+    )
 
-logger = logging.getLogger(__name__)
+
+def _stop_log_listener():
+    # 只停止本进程启动的监听线程
+    if _log_pid == os.getpid():
+        _log_listener.stop()
+
+
+atexit.register(_stop_log_listener)
 
 # 设置环境变量
 os.environ.setdefault('FLASK_ENV', 'development')
 os.environ.setdefault('FLASK_APP', 'run.py')
 
+# 配置日志
+if __name__ == '__main__' and os.getenv('FLASK_ENV') != 'development':
+    # 本进程只负责启动 gunicorn 并 fork worker, 不启动监听线程; worker 导入 run 模块时各自配置
+    logging.basicConfig(level=logging.INFO, format=_LOG_FORMAT)
+else:
+    setup_logging()
+
+logger = logging.getLogger(__name__)
+
 app = create_app(os.getenv('FLASK_ENV'))
 
 if __name__ == '__main__':
@@ -31,4 +75,10 @@ if __name__ == '__main__':
     logger.info(f'Starting CodeDiff backend in {os.getenv("FLASK_ENV")} mode')
     logger.info(f'Listening on {host}:{port}')
     
-    app.run(host=host, port=port, debug=debug, threaded=True)
+    if os.getenv('FLASK_ENV') == 'development':
+        app.run(host=host, port=port, debug=debug, threaded=True)
+    else:
+        # 非开发环境交给 gunicorn (gthread worker, 见 gunicorn_config.py), 不使用开发服务器
+        from gunicorn.app.wsgiapp import WSGIApplication
+        sys.argv = [sys.argv[0], '-c', 'gunicorn_config.py', '-b', f'{host}:{port}', 'run:app']
+        WSGIApplication('%(prog)s [OPTIONS] [APP_MODULE]').run()